@@ -5,6 +5,7 @@ from repertoire import create_repertoire_map, repertoire_ns, rearrangement_ns
 from service import ns as service_ns
 from utils import before_server_loads
 import json
+import gc
 
 logging.basicConfig(level=logging.INFO)
 
@@ -32,6 +33,11 @@ def create_app():
 
 app = create_app()
 
+# Move everything built at import time (including the repertoire index) out of the garbage
+# collector's tracking, so that collections in forked gunicorn workers do not write to the
+# pages shared with the master
+gc.freeze()
+
 if __name__ == '__main__':
     app.run(debug=app.config['DEBUG'], port=app.config["PORT"])
 
@@ -0,0 +1,5 @@
+# Import app.py once in the master, so that the repertoire index is built once and shared
+# with the workers after fork, rather than being rebuilt in every worker.
+# Note that with preloading, kill -HUP does not rebuild the index: after adding or changing
+# a study, restart gunicorn.
+preload_app = True
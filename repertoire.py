@@ -3,6 +3,8 @@ from flask import request, current_app, send_file
 import os
 import json
 import datetime
+from array import array
+from itertools import accumulate
 from json import JSONEncoder
 
 repertoire_map = None
@@ -138,15 +140,9 @@ class RepertoireResource(Resource):
             return {"error": str(e)}, 400
 
     # finding the repertoire metadata path by the repertoire id
+    # (if the id is in more than one metadata file, the last one is used)
     def find_repertoire_path_by_id(self, repertoire_id):
-        path = None
-        for metadata_path, repertoire_list in repertoire_map.items():
-            for repertoire in repertoire_list:
-                if repertoire == repertoire_id:
-                    path = metadata_path
-                    break
-
-        return path
+        return repertoire_map.find(repertoire_id, last=True)
 
     def get_metadata(self, repertoire_info, request_data):
         fields = request_data.get("fields", [])
@@ -248,7 +244,7 @@ class RepertoireList(Resource):
     # finding the right study and returning its repertoires
     def filter_repertoires_by_study(self, study_id):
         study_repertoires = []
-        for metadata_path, repertoire_list in repertoire_map.items():
+        for metadata_path in repertoire_map.metadata_paths():
             if study_id is None or study_id in metadata_path:
                 study_repertoires.extend(self.get_all_repertoires_by_study_id(metadata_path))
         
@@ -267,7 +263,7 @@ class RepertoireList(Resource):
     # returning all repertoires that available in the server
     def get_all_repertoires(self):
         all_repertoires = []
-        for metadata_path, repertoire_list in repertoire_map.items():
+        for metadata_path in repertoire_map.metadata_paths():
             study_repertoires = self.get_all_repertoires_by_study_id(metadata_path)
             for repertoire in study_repertoires:
                 all_repertoires.append(repertoire)
@@ -275,35 +271,128 @@ class RepertoireList(Resource):
         return all_repertoires
 
 
-# creating a map of metadata-path(key) and list of the repertoires in that(value)
+# read-only index of repertoire id -> metadata path
+# All strings are held in a single bytes object, addressed through array offsets, with the
+# repertoire ids sorted for binary search. Lookups therefore only create temporary objects and
+# never write to the memory holding the index, so when the app is preloaded in the gunicorn
+# master (see gunicorn.conf.py) the workers share the index with the master after fork
+# instead of each holding its own copy.
+# Strings are encoded with surrogatepass, so that lone surrogates (which json.load accepts, and
+# os.listdir uses for names that are not valid UTF-8) round-trip rather than raising.
+class RepertoireIndex:
+    __slots__ = ('_blob', '_offsets', '_studies', '_study_count', '_other_ids')
+
+    # study_lists: list of (metadata_path, list of repertoire ids), in study order
+    def __init__(self, study_lists):
+        strings = [metadata_path.encode(errors='surrogatepass') for metadata_path, _ in study_lists]
+        entries = sorted(((repertoire_id.encode(errors='surrogatepass'), study)
+                          for study, (_, repertoire_list) in enumerate(study_lists)
+                          for repertoire_id in repertoire_list if isinstance(repertoire_id, str)),
+                         key=lambda entry: entry[0])
+        strings.extend(repertoire_id for repertoire_id, _ in entries)
+
+        self._blob = b''.join(strings)
+        self._offsets = array('Q', accumulate((len(string) for string in strings), initial=0))
+        self._studies = array('I', (study for _, study in entries))
+        self._study_count = len(study_lists)
+
+        # ids that are not strings in the metadata (e.g. numbers) are rare, so they are kept as
+        # they are, in study order, and compared with == as the repertoire lists were
+        self._other_ids = tuple((repertoire_id, study)
+                                for study, (_, repertoire_list) in enumerate(study_lists)
+                                for repertoire_id in repertoire_list if not isinstance(repertoire_id, str))
+
+    def __len__(self):
+        return self._study_count
+
+    def repertoire_count(self):
+        return len(self._studies) + len(self._other_ids)
+
+    def _string(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]]
+
+    def _metadata_path(self, study):
+        return self._string(study).decode(errors='surrogatepass')
+
+    # index of the first repertoire entry whose id is >= (or > if right is set) the key
+    def _bisect(self, key, right=False):
+        lo, hi = 0, len(self._studies)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            repertoire_id = self._string(self._study_count + mid)
+            if repertoire_id < key or (right and repertoire_id == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # studies containing the repertoire id, in study order, with one entry per occurrence
+    def _studies_of(self, repertoire_id):
+        if isinstance(repertoire_id, str):
+            key = repertoire_id.encode(errors='surrogatepass')
+            # entries for the same id are in study order, as the sort in __init__ is stable
+            return [self._studies[i] for i in range(self._bisect(key), self._bisect(key, right=True))]
+        return [study for other_id, study in self._other_ids if other_id == repertoire_id]
+
+    def metadata_paths(self):
+        for study in range(self._study_count):
+            yield self._metadata_path(study)
+
+    # all metadata paths containing the repertoire id, each once and in study order
+    def find_all(self, repertoire_id):
+        studies = []
+        for study in self._studies_of(repertoire_id):
+            if not studies or studies[-1] != study:
+                studies.append(study)
+        return [self._metadata_path(study) for study in studies]
+
+    # the first (or last) metadata path containing the repertoire id, or None
+    def find(self, repertoire_id, last=False):
+        studies = self._studies_of(repertoire_id)
+        if not studies:
+            return None
+        return self._metadata_path(studies[-1] if last else studies[0])
+
+
+# creating an index of the repertoires in each metadata file
 def create_repertoire_map(studies_path):
     global repertoire_map
     print('Creating repertoire map')
+    repertoire_map = RepertoireIndex([])
     repertoire_log = []
-    repertoire_map = {}
-    studies_list = [study for study in os.listdir(studies_path)]
-    for study in studies_list:
-        print(f'Processing study: {study}')
-        study_path = os.path.join(studies_path, study)
-        metadata_path = os.path.join(study_path, 'metadata.json')
-        with open(metadata_path, 'r') as file:
-            data = json.load(file)
-            repertoire_list = []
-            for repertoire in data["Repertoire"]:
-                for rep, met in repertoire_log:
-                    if rep == repertoire["repertoire_id"]:
-                        print(f"*** Duplicate repertoire_id found: {repertoire['repertoire_id']} is in {met} and {metadata_path}")
-                else:
-                    file_path = metadata_path.replace('metadata.json', f"{repertoire['repertoire_id']}.tsv.gz")
-                    if os.path.exists(file_path):
-                        repertoire_log.append((repertoire["repertoire_id"], metadata_path))
+    study_lists = []
+    error = None
+    try:
+        studies_list = [study for study in os.listdir(studies_path)]
+        for study in studies_list:
+            print(f'Processing study: {study}')
+            study_path = os.path.join(studies_path, study)
+            metadata_path = os.path.join(study_path, 'metadata.json')
+            with open(metadata_path, 'r') as file:
+                data = json.load(file)
+                repertoire_list = []
+                for repertoire in data["Repertoire"]:
+                    for rep, met in repertoire_log:
+                        if rep == repertoire["repertoire_id"]:
+                            print(f"*** Duplicate repertoire_id found: {repertoire['repertoire_id']} is in {met} and {metadata_path}")
                     else:
-                        print(f"*** Repertoire file not found: {repertoire['repertoire_id']}: {file_path}")
-                repertoire_list.append(repertoire["repertoire_id"])
-            repertoire_map[metadata_path] = repertoire_list
-
+                        file_path = metadata_path.replace('metadata.json', f"{repertoire['repertoire_id']}.tsv.gz")
+                        if os.path.exists(file_path):
+                            repertoire_log.append((repertoire["repertoire_id"], metadata_path))
+                        else:
+                            print(f"*** Repertoire file not found: {repertoire['repertoire_id']}: {file_path}")
+                    repertoire_list.append(repertoire["repertoire_id"])
+                study_lists.append((metadata_path, repertoire_list))
+    except Exception as e:
+        # a bad study still leaves the server serving the studies that were read before it
+        error = e
+
+    repertoire_map = RepertoireIndex(study_lists)
     print(f'Created repertoire map with {len(repertoire_map)} metadata files and {len(repertoire_log)} repertoires')
 
+    if error is not None:
+        raise error
+
 
 def validate_fields(metadata, fields):
     missing_fields = []
@@ -413,30 +502,29 @@ class RearrangementResource(Resource):
         current_app.logger.info(f'Rearrangement count was reached with {repertoire_ids}')
         facet_list = []
         for repertoire in repertoire_ids:
-            for metadata_path, repertoire_list in repertoire_map.items():
-                if repertoire in repertoire_list:
-                    with open(metadata_path, 'r') as metadata_file:
-                        data = json.load(metadata_file)
-                        for file_repertoire in data["Repertoire"]:
-                            if file_repertoire["repertoire_id"] == repertoire:
-                                facet_list.append(
-                                    {
-                                        "repertoire_id": repertoire,
-                                        "count": 0
-                                    }
-                                )
+            for metadata_path in repertoire_map.find_all(repertoire):
+                with open(metadata_path, 'r') as metadata_file:
+                    data = json.load(metadata_file)
+                    for file_repertoire in data["Repertoire"]:
+                        if file_repertoire["repertoire_id"] == repertoire:
+                            facet_list.append(
+                                {
+                                    "repertoire_id": repertoire,
+                                    "count": 0
+                                }
+                            )
         return facet_list
 
     def get_rearrangements_file(self, repertoire_id):
         if isinstance(repertoire_id, list):
             repertoire_id = repertoire_id[0]
         current_app.logger.info(f'Rearrangement files was reached with {repertoire_id}')
-        for metadata_path, repertoire_list in repertoire_map.items():
-            if repertoire_id in repertoire_list:
-                # Construct the file path for the .tsv.gz file
-                filepath = metadata_path.replace('metadata.json', f"{repertoire_id}.tsv.gz")
-                print(filepath)
-                return filepath
+        metadata_path = repertoire_map.find(repertoire_id)
+        if metadata_path is not None:
+            # Construct the file path for the .tsv.gz file
+            filepath = metadata_path.replace('metadata.json', f"{repertoire_id}.tsv.gz")
+            print(filepath)
+            return filepath
 
         return None
 
@@ -0,0 +1,222 @@
+import os
+import json
+import pytest
+from flask import Flask
+from flask_restx import Api
+import repertoire
+from repertoire import RepertoireIndex, create_repertoire_map, repertoire_ns, rearrangement_ns
+
+
+STUDY_LISTS = [
+    ('/studies/A/metadata.json', ['3_IGH', '1_IGH', '3_IGH']),
+    ('/studies/B/metadata.json', ['2_IGH', '1_IGH']),
+    ('/studies/C/metadata.json', []),
+    ('/studies/D/metadata.json', ['1_IGH', 'é_IGH']),
+]
+
+
+# the lookups as they were made by scanning the previous dict of metadata path -> repertoire ids
+
+def scan_first(repertoire_map, repertoire_id):
+    for metadata_path, repertoire_list in repertoire_map.items():
+        if repertoire_id in repertoire_list:
+            return metadata_path
+    return None
+
+
+def scan_last(repertoire_map, repertoire_id):
+    path = None
+    for metadata_path, repertoire_list in repertoire_map.items():
+        for repertoire in repertoire_list:
+            if repertoire == repertoire_id:
+                path = metadata_path
+                break
+    return path
+
+
+def scan_all(repertoire_map, repertoire_id):
+    return [metadata_path for metadata_path, repertoire_list in repertoire_map.items() if repertoire_id in repertoire_list]
+
+
+@pytest.mark.parametrize('repertoire_id', ['1_IGH', '2_IGH', '3_IGH', 'é_IGH', '0_IGH', '4_IGH', '1_IG', '', 'zz'])
+def test_lookups_match_dict_scan(repertoire_id):
+    index = RepertoireIndex(STUDY_LISTS)
+    repertoire_map = dict(STUDY_LISTS)
+
+    assert index.find(repertoire_id) == scan_first(repertoire_map, repertoire_id)
+    assert index.find(repertoire_id, last=True) == scan_last(repertoire_map, repertoire_id)
+    assert index.find_all(repertoire_id) == scan_all(repertoire_map, repertoire_id)
+
+
+def test_metadata_paths():
+    index = RepertoireIndex(STUDY_LISTS)
+
+    assert list(index.metadata_paths()) == [metadata_path for metadata_path, _ in STUDY_LISTS]
+    assert len(index) == 4
+    assert index.repertoire_count() == 7
+
+
+def test_find_all_returns_each_file_once():
+    index = RepertoireIndex([('a', ['x', 'y', 'x']), ('b', ['x'])])
+
+    assert index.find_all('x') == ['a', 'b']
+
+
+def test_empty_index():
+    index = RepertoireIndex([])
+
+    assert len(index) == 0
+    assert list(index.metadata_paths()) == []
+    assert index.find('x') is None
+    assert index.find('x', last=True) is None
+    assert index.find_all('x') == []
+
+
+@pytest.mark.parametrize('repertoire_id', [123, ['x'], [['x']], None])
+def test_non_str_keys(repertoire_id):
+    index = RepertoireIndex([('a', ['x', '123'])])
+
+    assert index.find(repertoire_id) is None
+    assert index.find(repertoire_id, last=True) is None
+    assert index.find_all(repertoire_id) == []
+
+
+MIXED_STUDY_LISTS = [
+    ('a', [100, 'x', None, 100]),
+    ('b', ['100', 100, ['y'], 'None']),
+    ('c', ['\udc80', 100.0]),
+]
+
+
+@pytest.mark.parametrize('repertoire_id', [100, '100', 100.0, None, 'None', ['y'], 'y', '\udc80', '\ud800', 'x'])
+def test_mixed_ids_match_dict_scan(repertoire_id):
+    index = RepertoireIndex(MIXED_STUDY_LISTS)
+    repertoire_map = dict(MIXED_STUDY_LISTS)
+
+    assert index.find(repertoire_id) == scan_first(repertoire_map, repertoire_id)
+    assert index.find(repertoire_id, last=True) == scan_last(repertoire_map, repertoire_id)
+    assert index.find_all(repertoire_id) == scan_all(repertoire_map, repertoire_id)
+
+
+def test_surrogates_in_metadata_paths():
+    index = RepertoireIndex([('/studies/\udcff/metadata.json', ['x'])])
+
+    assert list(index.metadata_paths()) == ['/studies/\udcff/metadata.json']
+    assert index.find('x') == '/studies/\udcff/metadata.json'
+
+
+def test_create_repertoire_map_missing_studies_path(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        create_repertoire_map(str(tmp_path / 'missing'))
+
+    assert len(repertoire.repertoire_map) == 0
+    assert repertoire.repertoire_map.find('x') is None
+
+
+# a studies tree in which a_good, b2_<not UTF-8> and b_good load, c_bad fails and d_good is
+# therefore never read
+
+def write_study(studies_path, name, repertoires, files):
+    study_path = os.path.join(studies_path, name)
+    os.mkdir(study_path)
+    with open(os.path.join(study_path, b'metadata.json' if isinstance(name, bytes) else 'metadata.json'), 'w') as file:
+        json.dump({"Repertoire": repertoires}, file)
+    for repertoire_id in files:
+        file_name = f'{repertoire_id}.tsv.gz'.encode() if isinstance(name, bytes) else f'{repertoire_id}.tsv.gz'
+        with open(os.path.join(study_path, file_name), 'w') as file:
+            file.write(f'{name!r} {repertoire_id}')
+
+
+@pytest.fixture
+def studies_path(tmp_path, monkeypatch):
+    studies_path = str(tmp_path / 'studies')
+    os.mkdir(studies_path)
+    write_study(studies_path, 'a_good',
+                [{"repertoire_id": "1_IGH", "study": "a"},
+                 {"repertoire_id": "2_IGH", "study": "a"},
+                 {"repertoire_id": "2_IGH", "study": "a"},
+                 {"repertoire_id": 100, "study": "a"},
+                 {"repertoire_id": "\udc80", "study": "a"}],
+                ['1_IGH', '2_IGH', '100'])
+    write_study(os.fsencode(studies_path), b'b2_\xff', [{"repertoire_id": "3_IGH", "study": "b2"}], ['3_IGH'])
+    write_study(studies_path, 'b_good', [{"repertoire_id": "1_IGH", "study": "b"}], ['1_IGH'])
+    os.mkdir(os.path.join(studies_path, 'c_bad'))
+    with open(os.path.join(studies_path, 'c_bad', 'metadata.json'), 'w') as file:
+        file.write('{"Repertoire": [')
+    write_study(studies_path, 'd_good', [{"repertoire_id": "4_IGH", "study": "d"}], ['4_IGH'])
+
+    # read the studies in a fixed order, so that c_bad is reached after the good studies
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: sorted(listdir(path)))
+    return studies_path
+
+
+@pytest.fixture
+def client(studies_path, tmp_path):
+    app = Flask(__name__)
+    app.config.update(API_INFORMATION={"title": "test"}, USAGE_FILE_PATH=str(tmp_path / 'usage.json'), WEEKLY_LIMIT=10 ** 9)
+    api = Api(app)
+    api.add_namespace(repertoire_ns, path='/airr/v1/repertoire')
+    api.add_namespace(rearrangement_ns, path='/airr/v1/rearrangement')
+
+    with pytest.raises(json.JSONDecodeError):
+        create_repertoire_map(studies_path)
+
+    return app.test_client()
+
+
+def test_partial_load(client, studies_path):
+    assert [os.path.basename(os.path.dirname(path)) for path in repertoire.repertoire_map.metadata_paths()] == \
+        ['a_good', 'b2_\udcff', 'b_good']
+
+
+def test_get_repertoire(client):
+    response = client.get('/airr/v1/repertoire/1_IGH')
+    assert response.status_code == 200
+    assert response.get_json()["Repertoire"] == [{"repertoire_id": "1_IGH", "study": "b"}]
+
+    response = client.get('/airr/v1/repertoire/3_IGH')
+    assert response.get_json()["Repertoire"] == [{"repertoire_id": "3_IGH", "study": "b2"}]
+
+    for repertoire_id in ['100', 'None', '4_IGH', '5_IGH']:
+        response = client.get(f'/airr/v1/repertoire/{repertoire_id}')
+        assert response.get_json()["Repertoire"] == ["Not Found"]
+
+
+def test_get_rearrangement_file(client):
+    response = client.get('/airr/v1/rearrangement/1_IGH')
+    assert response.status_code == 200
+    assert response.data == b"'a_good' 1_IGH"
+    assert 'a_good_1_IGH.tsv.gz' in response.headers['Content-Disposition']
+
+    for repertoire_id in ['100', '4_IGH']:
+        response = client.get(f'/airr/v1/rearrangement/{repertoire_id}')
+        assert response.status_code == 404
+
+    for value, data in [(["2_IGH"], b"'a_good' 2_IGH"), ([100], b"'a_good' 100")]:
+        response = client.post('/airr/v1/rearrangement', json={
+            "filters": {"op": "=", "content": {"field": "repertoire_id", "value": value}}, "format": "tsv"})
+        assert response.status_code == 200
+        assert response.data == data
+
+    for value in [["100"], [["x"]], ["\ud800"]]:
+        response = client.post('/airr/v1/rearrangement', json={
+            "filters": {"op": "=", "content": {"field": "repertoire_id", "value": value}}, "format": "tsv"})
+        assert response.status_code == 404
+
+
+@pytest.mark.parametrize('value, facets', [
+    (["1_IGH"], [{"repertoire_id": "1_IGH", "count": 0}] * 2),
+    (["2_IGH"], [{"repertoire_id": "2_IGH", "count": 0}] * 2),
+    ([100], [{"repertoire_id": 100, "count": 0}]),
+    (["100"], []),
+    (["\udc80"], [{"repertoire_id": "\udc80", "count": 0}]),
+    (["\ud800"], []),
+    ([["x"]], []),
+    (["4_IGH"], []),
+])
+def test_rearrangement_facets(client, value, facets):
+    response = client.post('/airr/v1/rearrangement', json={
+        "filters": {"op": "in", "content": {"field": "repertoire_id", "value": value}}, "facets": "repertoire_id"})
+    assert response.status_code == 200
+    assert response.get_json()["Facet"] == facets